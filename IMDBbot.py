@@ -1,4 +1,6 @@
 import os
+import time
+import asyncio
 import logging
 from uuid import uuid4
 from datetime import datetime
@@ -6,7 +8,6 @@ from telegram import Update, InlineQueryResultArticle, InputTextMessageContent,
 from telegram.constants import ParseMode
 from telegram.ext import Application, Updater, InlineQueryHandler, CommandHandler, CallbackQueryHandler, ChosenInlineResultHandler, MessageHandler, filters, ContextTypes
 import movie
-from movie import ia
 import hashlib
 from dotenv import load_dotenv
 
@@ -17,6 +18,14 @@ load_dotenv()
 TOKEN = os.getenv('TOKEN')
 DATABASE = '/storage/emulated/0/Download/IMDBbot/database/imdb_db.sqlite3'
 JOB_TIME = (9, 30) # time at which notifications are sent (UTC)
+PREFETCH_TIME = (3, 0) # quiet hours time at which upcoming titles are pre-fetched (UTC)
+PREFETCH_DELAY = 5 # seconds to wait between pre-fetched titles
+REVALIDATE_TIME = (2, 0) # time at which stored release dates are re-checked (UTC)
+# (releasing within days, re-check every days), None matches all later titles
+REVALIDATE_TIERS = ((7, 1), (30, 7), (None, 30))
+REVALIDATE_DELAY = 5 # seconds to wait between re-checked titles
+INLINE_FIRST_PAGE = 5 # inline results enriched before the user sees anything
+INLINE_PAGE_SIZE = 10 # inline results enriched per page when scrolling
 
 
 # setup a simple logging
@@ -44,6 +53,45 @@ def notify_users(context):
                                  parse_mode=ParseMode.HTML)
 
 
+def next_notify_titles():
+    """
+    Return (title_id, title_episode_id) pairs the next notify run will send.
+    Fetched data is only kept for a day, so later titles aren't worth fetching
+    """
+
+    now = datetime.now()
+    notify_time = now.replace(hour=int(JOB_TIME[0]), minute=int(JOB_TIME[1]),
+                              second=0, microsecond=0)
+    days_ahead = 0 if now < notify_time else 1
+    return movie.Alert(DATABASE).releasing_on(days_ahead)
+
+
+async def prefetch_titles(context):
+    """
+    Pre-fetch IMDb data for titles released on the next notify run so it
+    only has to send
+    """
+
+    movie.purge_cache()
+    titles = next_notify_titles()
+    if not isinstance(titles, list):
+        return
+    LOG.info('Pre-fetching %d upcoming titles', len(titles))
+    for title_id, title_episode_id in titles:
+        # Fetch off the event loop and pace requests to keep load low
+        await asyncio.to_thread(movie.prefetch, title_id, title_episode_id)
+        await asyncio.sleep(PREFETCH_DELAY)
+
+
+async def revalidate_releases(context):
+    """
+    Re-check stored release dates for postponed or rescheduled titles
+    """
+
+    alert = movie.Alert(DATABASE)
+    await asyncio.to_thread(alert.revalidate, REVALIDATE_TIERS, REVALIDATE_DELAY)
+
+
 def result_id(title_id):
     """
     Generate UUID containig IMDb title ID
@@ -212,17 +260,29 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not query:
         return
 
-    # Search IMDb for the query
-    search_results = ia.search_movie(query)
+    # Telegram sends back the next_offset of the previous page when scrolling
+    try:
+        offset = int(update.inline_query.offset or 0)
+    except ValueError:
+        offset = 0
+
+    # Search IMDb for the query, reusing the results kept for earlier pages.
+    # IMDb calls block, so they run in threads to keep other updates moving
+    search_results = await asyncio.to_thread(movie.search_results, query)
+    page_size = INLINE_FIRST_PAGE if offset == 0 else INLINE_PAGE_SIZE
+    page_end = offset + page_size
+    page = search_results[offset:page_end]  # Only enrich this page
+    ia = movie.get_ia()
+    page_data = await asyncio.gather(*[asyncio.to_thread(ia.get_movie, imdb_movie.movieID)
+                                       for imdb_movie in page])
     results = []
     
-    for movie in search_results:  # Limit to top 5 results
-        title = movie.get('title', 'N/A')
-        year = movie.get('year', 'N/A')
-        imdb_id = movie.movieID
+    for imdb_movie, movie_data in zip(page, page_data):
+        title = imdb_movie.get('title', 'N/A')
+        year = imdb_movie.get('year', 'N/A')
+        imdb_id = imdb_movie.movieID
 
         # Get the movie data
-        movie_data = ia.get_movie(imdb_id)
         genres = ', '.join(movie_data.get('genres', ['N/A']))
         plot = movie_data.get('plot', ['N/A'])[0]  # Get the first plot summary
         rating = movie_data.get('rating', 'N/A')
@@ -245,8 +305,9 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         results.append(result)
 
-    # Send the results back to the user
-    await update.inline_query.answer(results, cache_time=1)
+    # Send the results back to the user, with an offset for the next page if any
+    next_offset = str(page_end) if page_end < len(search_results) else ''
+    await update.inline_query.answer(results, cache_time=1, next_offset=next_offset)
     
 
 def log_error(update, context):
@@ -257,26 +318,52 @@ def log_error(update, context):
     LOG.error('Update "%s" caused error: "%s"', update, context.error)
 
 
-def main():
+def warm_up():
     """
-    Create the updater and Application handlers
+    Run the startup sequence before polling: open the database and apply
+    migrations, load the IMDb client, pre-warm its connection, preload the
+    cache for the next notify run, then report readiness
     """
-    # Get the Application to register handlers
-    app = Application.builder().token(TOKEN).build()
-
-    # Create the bot's alert database
-    movie.Alert(DATABASE).create_db()
 
-    # Create the updater and pass the bot's token. 
-    #(old and new updater Commented so i can find out it usfull or not)
-    #updater = Updater(TOKEN, use_context=True, workers=32)
-    #updater = Updater(TOKEN, workers=32)
-    
-    # Create repeating job to notify users
-    job_start_time = datetime.time(datetime.now().replace(hour=int(JOB_TIME[0]),
-                                                          minute=int(JOB_TIME[1])))
-    job = app.job_queue
-    job.run_repeating(notify_users, interval=86400, first=job_start_time)
+    start = time.perf_counter()
+
+    # Open the bot's alert database and apply pending migrations
+    stage = time.perf_counter()
+    if movie.Alert(DATABASE).create_db() is not True:
+        raise RuntimeError('Unable to create the alert database')
+    LOG.info('Startup: database ready in %.3fs', time.perf_counter() - stage)
+
+    # Import and construct the IMDb client so the first query doesn't pay for it
+    stage = time.perf_counter()
+    movie.get_ia()
+    LOG.info('Startup: IMDb client loaded in %.3fs', time.perf_counter() - stage)
+
+    # Open a keep-alive connection to IMDb, startup goes on without it if offline
+    stage = time.perf_counter()
+    try:
+        if movie.warm_connections():
+            LOG.info('Startup: IMDb connection ready in %.3fs',
+                     time.perf_counter() - stage)
+    except OSError as err:
+        LOG.warning('Startup: unable to pre-warm IMDb connection: "%s"', err)
+
+    # A restart empties the cache, so preload the next notify run's titles,
+    # unpaced as no updates are being handled yet
+    stage = time.perf_counter()
+    titles = next_notify_titles()
+    if isinstance(titles, list):
+        for title_id, title_episode_id in titles:
+            movie.prefetch(title_id, title_episode_id)
+        LOG.info('Startup: preloaded %d titles in %.3fs', len(titles),
+                 time.perf_counter() - stage)
+
+    LOG.info('Startup: ready in %.3fs', time.perf_counter() - start)
+
+
+def add_handlers(app):
+    """
+    Register the bot's command, inline and callback handlers on the Application
+    """
 
     # On different commands - answer in Telegram
     app.add_handler(CommandHandler("start", help_cmd))
@@ -301,6 +388,41 @@ def main():
     # Log all errors
     app.add_error_handler(log_error)
 
+
+def main():
+    """
+    Create the updater and Application handlers
+    """
+    # Get the Application to register handlers
+    app = Application.builder().token(TOKEN).build()
+
+    # Prepare the database and IMDb client before accepting updates
+    warm_up()
+
+    # Create the updater and pass the bot's token. 
+    #(old and new updater Commented so i can find out it usfull or not)
+    #updater = Updater(TOKEN, use_context=True, workers=32)
+    #updater = Updater(TOKEN, workers=32)
+    
+    # Create repeating job to notify users
+    job_start_time = datetime.time(datetime.now().replace(hour=int(JOB_TIME[0]),
+                                                          minute=int(JOB_TIME[1])))
+    job = app.job_queue
+    job.run_repeating(notify_users, interval=86400, first=job_start_time)
+
+    # Create repeating job to pre-fetch upcoming titles during quiet hours
+    prefetch_start_time = datetime.time(datetime.now().replace(hour=int(PREFETCH_TIME[0]),
+                                                               minute=int(PREFETCH_TIME[1])))
+    job.run_repeating(prefetch_titles, interval=86400, first=prefetch_start_time)
+
+    # Create repeating job to re-check stored release dates
+    revalidate_start_time = datetime.time(datetime.now().replace(hour=int(REVALIDATE_TIME[0]),
+                                                                 minute=int(REVALIDATE_TIME[1])))
+    job.run_repeating(revalidate_releases, interval=86400, first=revalidate_start_time)
+
+    # Register command, inline query and button handlers
+    add_handlers(app)
+
     # Start the Bot
     app.run_polling()
 
@@ -10,6 +10,36 @@ import logging
 # Setup logger
 LOG = logging.getLogger(__name__)
 
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = (
+    '''CREATE TABLE IF NOT EXISTS imdb_alerts
+       (user_id TEXT,
+        user_name TEXT,
+        title_id TEXT,
+        title_name TEXT,
+        title_episode_id TEXT,
+        title_release TIMESTAMP);''',
+    # Store each title once and keep only (user, title) pairs per subscriber
+    '''CREATE TABLE titles
+       (title_id TEXT PRIMARY KEY,
+        title_name TEXT,
+        title_episode_id TEXT,
+        title_release TIMESTAMP);
+    CREATE TABLE subscriptions
+       (user_id TEXT,
+        user_name TEXT,
+        title_id TEXT REFERENCES titles(title_id),
+        PRIMARY KEY (user_id, title_id));
+    CREATE INDEX subscriptions_title_id ON subscriptions(title_id);
+    CREATE INDEX titles_title_release ON titles(title_release);
+    INSERT INTO titles
+        SELECT title_id, title_name, title_episode_id, MIN(title_release)
+        FROM imdb_alerts GROUP BY title_id;
+    INSERT OR IGNORE INTO subscriptions
+        SELECT user_id, user_name, title_id FROM imdb_alerts;
+    DROP TABLE imdb_alerts;''',
+)
+
 
 def _catch_and_log(func):
     """
@@ -50,19 +80,20 @@ class Database():
     @_catch_and_log
     def create_table(self):
         """
-        Create IMDb bot alert table
+        Create IMDb bot alert tables by applying any pending schema migrations
         """
 
-        self.cur.execute('''CREATE TABLE IF NOT EXISTS imdb_alerts
-                            (user_id TEXT,
-                             user_name TEXT,
-                             title_id TEXT,
-                             title_name TEXT,
-                             title_episode_id TEXT,
-                             title_release TIMESTAMP)''')
+        version = self.cur.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            LOG.info('Applying database migration %d', number)
+            try:
+                self.cur.executescript('BEGIN;\n{0}\nPRAGMA user_version = {1};\n'
+                                       'COMMIT;'.format(migration, number))
+            except sqlite3.Error:
+                self.con.rollback()
+                raise
         return True
 
-        self.con.commit()
 
     @_catch_and_log
     def query_title_name(self, user_id):
@@ -70,7 +101,8 @@ class Database():
         Return all IMDb title names from user's alerts
         """
 
-        query = self.cur.execute('''SELECT title_name FROM imdb_alerts
+        query = self.cur.execute('''SELECT title_name FROM titles
+                                    JOIN subscriptions USING (title_id)
                                     WHERE user_id=?''', (user_id, ))
         rows = query.fetchall()
         results = [row[0] for row in rows if rows]
@@ -83,7 +115,7 @@ class Database():
         Return all IMDb title IDs from user's alerts
         """
 
-        query = self.cur.execute('''SELECT title_id FROM imdb_alerts
+        query = self.cur.execute('''SELECT title_id FROM subscriptions
                                     WHERE user_id=?''', (user_id, ))
         rows = query.fetchall()
         results = [row[0] for row in rows if rows]
@@ -97,7 +129,8 @@ class Database():
         """
 
         values = (user_id, title_id)
-        query = self.cur.execute('''SELECT title_name FROM imdb_alerts
+        query = self.cur.execute('''SELECT title_name FROM titles
+                                    JOIN subscriptions USING (title_id)
                                     WHERE user_id=? AND title_id=?''', (values))
         result = query.fetchone()
         return result
@@ -106,17 +139,59 @@ class Database():
     @_catch_and_log
     def query_released(self, today):
         """
-        Return all user_id, title_id and title_episode_id where title_release
+        Return all title_id and title_episode_id where title_release
         is today's date
         """
 
-        query = self.cur.execute('''SELECT user_id, title_id, title_episode_id
-                                    FROM imdb_alerts
+        query = self.cur.execute('''SELECT title_id, title_episode_id
+                                    FROM titles
                                     WHERE title_release=?''', (today, ))
         results = query.fetchall()
         return results
 
 
+    @_catch_and_log
+    def query_subscribers(self, title_id):
+        """
+        Return all user IDs with an alert for the title
+        """
+
+        query = self.cur.execute('''SELECT user_id FROM subscriptions
+                                    WHERE title_id=?''', (title_id, ))
+        rows = query.fetchall()
+        results = [row[0] for row in rows if rows]
+        return results
+
+
+    @_catch_and_log
+    def query_releasing(self, start, end):
+        """
+        Return title_id and title_episode_id where title_release falls
+        between start (inclusive) and end (exclusive), soonest first
+        """
+
+        query = self.cur.execute('''SELECT title_id, title_episode_id
+                                    FROM titles
+                                    WHERE title_release>=? AND title_release<?
+                                    ORDER BY title_release''', (start, end))
+        results = query.fetchall()
+        return results
+
+
+    @_catch_and_log
+    def query_titles(self):
+        """
+        Return title_id, title_episode_id and title_release of all titles,
+        soonest release first
+        """
+
+        query = self.cur.execute('''SELECT title_id, title_episode_id, title_release
+                                    FROM titles
+                                    ORDER BY title_release''')
+        results = query.fetchall()
+        return results
+
+
     @_catch_and_log
     def insert(self, values):
         """
@@ -126,9 +201,15 @@ class Database():
                   title_episode_id, title_release)
         """
 
-        self.cur.execute('''INSERT INTO imdb_alerts
-                            VALUES(?, ?, ?, ?, ?, ?)''', values)
-        self.con.commit()
+        user_id, user_name, title_id = values[:3]
+        with self.con:
+            self.cur.execute('''INSERT INTO titles VALUES(?, ?, ?, ?)
+                                ON CONFLICT(title_id) DO UPDATE SET
+                                    title_name=excluded.title_name,
+                                    title_episode_id=excluded.title_episode_id,
+                                    title_release=excluded.title_release''', values[2:])
+            self.cur.execute('''INSERT OR IGNORE INTO subscriptions
+                                VALUES(?, ?, ?)''', (user_id, user_name, title_id))
         message = 'Alert enabled.'
         return message
 
@@ -136,32 +217,64 @@ class Database():
     @_catch_and_log
     def update(self, values):
         """
-        Update existing values with new episode ID
+        Update existing title with new episode ID
+
+        values = (title_episode_id, title_release, title_id)
         """
 
-        self.cur.execute('''UPDATE imdb_alerts
+        self.cur.execute('''UPDATE titles
                             SET title_episode_id=?,
                                 title_release=?
-							WHERE
-                                user_id=?
-                            AND
+                            WHERE
                                 title_id=?''', values)
         self.con.commit()
 
 
+    @_catch_and_log
+    def update_releases(self, values):
+        """
+        Update release dates of many titles in a single transaction
+
+        values = [(title_release, title_id, title_episode_id), ...]
+        """
+
+        with self.con:
+            self.cur.executemany('''UPDATE titles
+                                    SET title_release=?
+                                    WHERE title_id=?
+                                    AND title_episode_id IS ?''', values)
+        return self.cur.rowcount
+
+
     @_catch_and_log
     def delete(self, user_id, title_id):
         """
-        Delete the title ID belonging to user ID from the database
+        Delete the title ID belonging to user ID from the database, and the
+        title itself once nobody is subscribed to it
         """
 
-        self.cur.execute('''DELETE FROM imdb_alerts WHERE
-                            user_id=? AND title_id=?''', (user_id, title_id))
-        self.con.commit()
+        with self.con:
+            self.cur.execute('''DELETE FROM subscriptions WHERE
+                                user_id=? AND title_id=?''', (user_id, title_id))
+            self.cur.execute('''DELETE FROM titles WHERE title_id=?
+                                AND NOT EXISTS (SELECT 1 FROM subscriptions
+                                                WHERE title_id=?)''', (title_id, title_id))
         message = 'Alert disabled.'
         return message
 
 
+    @_catch_and_log
+    def delete_title(self, title_id):
+        """
+        Delete the title ID and every user's alert for it from the database
+        """
+
+        with self.con:
+            self.cur.execute('''DELETE FROM subscriptions WHERE title_id=?''',
+                             (title_id, ))
+            self.cur.execute('''DELETE FROM titles WHERE title_id=?''', (title_id, ))
+
+
     @_catch_and_log
     def close(self):
         """
@@ -0,0 +1,397 @@
+"""
+Replay Telegram updates through the bot's real handler stack to find its
+saturation point.
+
+Updates are read as JSON lines (one Telegram Update object per line) or
+synthesized as user sessions: inline search, chosen result, enable or
+disable alert, then /alerts. They are fed into an Application that talks
+to an in-process fake Bot API, with the IMDb client replaced by a stub
+that sleeps to simulate network latency. Per-user update order is kept,
+and half of the synthetic sessions scroll to a second page of results.
+
+    python loadtest.py --synthesize 200 --rate 20 --concurrency 32
+    python loadtest.py --updates recorded.jsonl --rate 0
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import re
+import resource
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from telegram import Update
+from telegram.request import BaseRequest
+
+import IMDBbot
+import movie
+
+
+# Setup logger
+LOG = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'IMDBbot', 'username': 'IMDBbot'}
+SEARCH_QUERIES = ('matrix', 'dune', 'severance', 'the office', 'alien', 'fargo')
+CALLBACK_HANDLERS = ('enable_alert', 'disable_alert', 'dismiss')
+
+
+class FakeBotAPI(BaseRequest):
+    """
+    In-process Bot API answering every method locally after an optional delay
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        """
+        Record the Bot API method and return a successful response for it
+        """
+
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if api_method == 'getMe':
+            result = BOT_USER
+        elif api_method == 'sendMessage':
+            params = request_data.parameters if request_data else {}
+            result = {'message_id': self.calls[api_method],
+                      'date': int(time.time()),
+                      'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                      'text': params.get('text', '')}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+class FakeTitle(dict):
+    """
+    Minimal stand-in for a Cinemagoer Movie object
+    """
+
+    def __init__(self, movie_id, **fields):
+        super().__init__(**fields)
+        self.movieID = movie_id
+
+    def getID(self):
+        return self.movieID
+
+
+class FakeIMDb():
+    """
+    Blocking IMDb backend stub, sleeping like Cinemagoer's page fetches do
+    """
+
+    def __init__(self, latency=0.0, results=20):
+        self.latency = latency
+        self.results = results
+
+    def _fetch(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def search_movie(self, name):
+        self._fetch()
+        seed = sum(map(ord, name))
+        return [FakeTitle('{0:07d}'.format(seed * 100 + i), title='{0} {1}'.format(name, i),
+                          year=2020 + i % 8)
+                for i in range(self.results)]
+
+    def get_movie(self, title_id, info=None):
+        self._fetch()
+        is_series = int(title_id) % 2 == 0
+        return FakeTitle(title_id, title='Title {0}'.format(title_id), year=2027,
+                         kind='tv series' if is_series else 'movie',
+                         genres=['Drama'], plot=['A plot.'], rating=7.5,
+                         cast=[{'name': 'An Actor'}],
+                         seasons=[1] if is_series else None,
+                         **{'long imdb title': 'Title {0} (2027)'.format(title_id)})
+
+    def get_movie_release_info(self, title_id):
+        self._fetch()
+        release = (datetime.now() + timedelta(days=30)).strftime('%d %B %Y')
+        return {'data': {'raw release dates': [{'country': 'USA\n', 'date': release}]}}
+
+    def get_movie_episodes(self, title_id):
+        self._fetch()
+        air_date = (datetime.now() + timedelta(days=7)).strftime('%d %b %Y')
+        episode = FakeTitle(str(int(title_id) + 1), **{'original air date': air_date})
+        return {'data': {'episodes': {1: {1: episode}}}}
+
+    def get_episode(self, episode_id):
+        return self.get_movie(episode_id)
+
+
+def synthesize(sessions, seed=0):
+    """
+    Return update dicts for the given number of user sessions, interleaved
+    """
+
+    rand = random.Random(seed)
+    update_ids = itertools.count(1)
+    streams = []
+    for session in range(sessions):
+        user = {'id': 1000 + session, 'is_bot': False, 'first_name': 'User{0}'.format(session)}
+        title_id = '{0:07d}'.format(rand.randrange(1, 10 ** 6))
+        button = rand.choice((IMDBbot.enable_alert, IMDBbot.disable_alert))
+        search = rand.choice(SEARCH_QUERIES)
+        pages = [''] if rand.random() < 0.5 else ['', str(IMDBbot.INLINE_FIRST_PAGE)]
+        streams.append([
+            {'inline_query': {'id': str(session), 'from': user, 'offset': offset,
+                              'query': search}}
+            for offset in pages
+        ] + [
+            {'chosen_inline_result': {'result_id': IMDBbot.result_id(title_id),
+                                      'from': user, 'query': '',
+                                      'inline_message_id': str(session)}},
+            {'callback_query': {'id': str(session), 'from': user, 'chat_instance': '1',
+                                'inline_message_id': str(session), 'data': str(button)}},
+            {'message': {'message_id': session, 'date': int(time.time()),
+                         'chat': {'id': user['id'], 'type': 'private'}, 'from': user,
+                         'text': '/alerts',
+                         'entities': [{'type': 'bot_command', 'offset': 0, 'length': 7}]}},
+        ])
+
+    # Interleave sessions so users overlap like they do in real traffic
+    updates = []
+    while streams:
+        stream = rand.choice(streams)
+        update = stream.pop(0)
+        update['update_id'] = next(update_ids)
+        updates.append(update)
+        if not stream:
+            streams.remove(stream)
+    return updates
+
+
+def callback_name(data):
+    """
+    Return the handler name in button callback data, which the bot sets to
+    str(handler), e.g. '<function enable_alert at 0x...>', or None
+    """
+
+    found = re.search(r'function (\w+)', data or '')
+    return found.group(1) if found else None
+
+
+def rebind_callbacks(updates):
+    """
+    Rewrite recorded callback data to this process's str(handler), as the
+    recorded memory addresses don't match the handler patterns here
+    """
+
+    for data in updates:
+        callback_query = data.get('callback_query')
+        if not callback_query:
+            continue
+        name = callback_name(callback_query.get('data'))
+        if name is None and callback_query.get('data') in CALLBACK_HANDLERS:
+            name = callback_query['data']
+        if name in CALLBACK_HANDLERS:
+            callback_query['data'] = str(getattr(IMDBbot, name))
+    return updates
+
+
+def update_kind(update):
+    """
+    Name the handler an update is routed to, for per-handler latency stats
+    """
+
+    if update.inline_query:
+        return 'inline_query'
+    if update.chosen_inline_result:
+        return 'chosen_result'
+    if update.callback_query:
+        return callback_name(update.callback_query.data) or 'callback'
+    if update.message and update.message.text:
+        return update.message.text.split()[0]
+    return 'other'
+
+
+def percentiles(samples):
+    """
+    Return p50, p90, p99 and max of samples in milliseconds
+    """
+
+    if len(samples) < 2:
+        value = samples[0] * 1000 if samples else 0.0
+        return value, value, value, value
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return cuts[49] * 1000, cuts[89] * 1000, cuts[98] * 1000, max(samples) * 1000
+
+
+async def monitor_loop_lag(samples, interval=0.01):
+    """
+    Record how late the event loop wakes up from a fixed sleep
+    """
+
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(time.perf_counter() - start - interval, 0.0))
+
+
+async def replay(app, updates, rate, concurrency):
+    """
+    Feed updates into the Application at the given arrival rate (updates per
+    second, 0 for as fast as possible) and return handler latencies by kind
+    """
+
+    latencies = {}
+    failures = []
+    semaphore = asyncio.Semaphore(concurrency)
+    user_locks = {}
+
+    async def handle(update, user_lock):
+        # Per-user lock keeps each user's updates in order, FIFO on arrival
+        async with user_lock, semaphore:
+            start = time.perf_counter()
+            try:
+                await app.process_update(update)
+                kind = update_kind(update)
+            except Exception as err:
+                # one bad update must not abort the whole run
+                LOG.warning('Update %s failed: "%s"', update.update_id, err)
+                failures.append(err)
+                return
+            latencies.setdefault(kind, []).append(time.perf_counter() - start)
+
+    tasks = []
+    for data in updates:
+        try:
+            update = Update.de_json(data, app.bot)
+        except Exception as err:
+            LOG.warning('Unable to parse update %s: "%s"', data.get('update_id'), err)
+            failures.append(err)
+            continue
+        user = update.effective_user
+        user_lock = user_locks.setdefault(user.id if user else None, asyncio.Lock())
+        tasks.append(asyncio.create_task(handle(update, user_lock)))
+        if rate:
+            # Poisson arrivals at the requested mean rate
+            await asyncio.sleep(random.expovariate(rate))
+        else:
+            await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return latencies, failures
+
+
+async def run(args, updates):
+    """
+    Build the Application against the fakes, replay updates and print a report
+    """
+
+    bot_api = FakeBotAPI(args.api_latency)
+    app = (IMDBbot.Application.builder().token('1:LOADTEST')
+           .request(bot_api).get_updates_request(FakeBotAPI())
+           .build())
+    IMDBbot.add_handlers(app)
+    errors = []
+
+    async def count_error(update, context):
+        errors.append(context.error)
+    app.add_error_handler(count_error)
+
+    lag = []
+    usage_start = resource.getrusage(resource.RUSAGE_SELF)
+    async with app:
+        monitor = asyncio.create_task(monitor_loop_lag(lag))
+        start = time.perf_counter()
+        latencies, failures = await replay(app, updates, args.rate, args.concurrency)
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    handled = sum(len(samples) for samples in latencies.values())
+    print('{0} updates in {1:.2f}s ({2:.1f}/s), {3} handler errors, '
+          '{4} failed updates'.format(handled, elapsed, handled / elapsed if elapsed else 0.0,
+                                      len(errors), len(failures)))
+    print('\n{0:<16}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}'.format(
+        'handler', 'count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms'))
+    for kind, samples in sorted(latencies.items()):
+        print('{0:<16}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(
+            kind, len(samples), *percentiles(samples)))
+    print('{0:<16}{1:>8}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(
+        'event loop lag', len(lag), *percentiles(lag)))
+    print('\nCPU user {0:.2f}s, system {1:.2f}s, max RSS {2:.1f} MiB'.format(
+        usage_end.ru_utime - usage_start.ru_utime,
+        usage_end.ru_stime - usage_start.ru_stime,
+        usage_end.ru_maxrss / 1024))
+    print('Bot API calls: {0}'.format(', '.join('{0}={1}'.format(method, count)
+                                               for method, count
+                                               in sorted(bot_api.calls.items()))))
+
+
+def main():
+    """
+    Parse arguments, set up the stubbed backends and run the replay
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--updates', help='JSON lines file of Telegram updates to replay')
+    source.add_argument('--synthesize', type=int, metavar='SESSIONS',
+                        help='number of synthetic user sessions to generate')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='mean arrival rate in updates per second, 0 for no pacing')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='maximum updates handled at once')
+    parser.add_argument('--imdb-latency', type=float, default=0.2,
+                        help='seconds each stubbed IMDb fetch blocks for')
+    parser.add_argument('--imdb-results', type=int, default=20,
+                        help='results returned by the stubbed IMDb search')
+    parser.add_argument('--api-latency', type=float, default=0.0,
+                        help='seconds each fake Bot API call waits for')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('telegram').setLevel(logging.CRITICAL)
+    IMDBbot.LOG.setLevel(logging.CRITICAL)
+
+    if args.updates:
+        updates = []
+        with open(args.updates) as updates_file:
+            for number, line in enumerate(updates_file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    updates.append(json.loads(line))
+                except json.JSONDecodeError as err:
+                    LOG.warning('Skipping line %d: "%s"', number, err)
+        rebind_callbacks(updates)
+    else:
+        updates = synthesize(args.synthesize, args.seed)
+
+    # Point the bot at a throwaway database and the stubbed IMDb backend
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        IMDBbot.DATABASE = os.path.join(tmp_dir, 'loadtest.sqlite3')
+        movie.Alert(IMDBbot.DATABASE).create_db()
+        movie._ia = FakeIMDb(args.imdb_latency, args.imdb_results)
+        asyncio.run(run(args, updates))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,42 @@
 import functools
 import logging
+import threading
+import time
+from re import match
 from datetime import datetime, timedelta
-from imdb import Cinemagoer
 import db
 
 # Global logger & vars
 LOG = logging.getLogger(__name__)
-ia = Cinemagoer()  # Initialize Cinemagoer
+_ia = None  # Cinemagoer instance, created on first use by get_ia()
+_ia_lock = threading.Lock()
+# transport.install() options for the IMDb client, None keeps Cinemagoer's own fetching.
+# HTTPS certificates are verified: set ca_file where there is no system CA bundle
+# (e.g. Termux), or verify to False to skip checks like Cinemagoer does
+TRANSPORT_OPTIONS = {'pool_size': 4, 'store_size': 512, 'timeout': 30,
+                     'ca_file': None, 'verify': True}
+CACHE_TTL = timedelta(days=1)  # how long pre-fetched IMDb data stays fresh
+_cache = {}  # (kind, IMDb ID) -> (fetch time, IMDb data)
+SEARCH_TTL = timedelta(minutes=5)  # how long search results are kept for paging
+_search_cache = {}  # search string -> (search time, IMDb search results)
+
+
+def get_ia():
+    """
+    Return the shared Cinemagoer instance, importing and creating it on first use.
+    """
+    global _ia
+    if _ia is None:
+        with _ia_lock:
+            if _ia is None:
+                from imdb import Cinemagoer
+                ia = Cinemagoer()
+                if TRANSPORT_OPTIONS is not None:
+                    import transport
+                    transport.install(ia, **TRANSPORT_OPTIONS)
+                _ia = ia
+    return _ia
+
 
 def _catch_and_log(func):
     """
@@ -21,12 +51,151 @@ def _catch_and_log(func):
             return 'Unexpected error occurred.'
     return try_func
 
+
+def warm_connections():
+    """
+    Open a pooled connection to IMDb ahead of the first lookup. Return False
+    if Cinemagoer's own fetching is in use and there is no pool to warm.
+    """
+    ia = get_ia()
+    pool = getattr(getattr(ia, 'urlOpener', None), 'pool', None)
+    if pool is None:
+        return False
+    pool.warm(ia.urls['movie_main'] % '0')
+    return True
+
+
+def _cached(kind, imdb_id, refresh=False):
+    """
+    Return IMDb movie or episode data, from the cache while it is still fresh
+    unless refresh is set.
+    """
+    key = (kind, str(imdb_id))
+    entry = _cache.get(key)
+    if entry and not refresh and datetime.now() - entry[0] < CACHE_TTL:
+        return entry[1]
+    data = getattr(get_ia(), 'get_' + kind)(imdb_id)
+    _cache[key] = (datetime.now(), data)
+    return data
+
+
+def get_movie(title_id, refresh=False):
+    """
+    Return full IMDb data for a title, cached.
+    """
+    return _cached('movie', title_id, refresh)
+
+
+def get_episode(episode_id, refresh=False):
+    """
+    Return full IMDb data for an episode, cached.
+    """
+    return _cached('episode', episode_id, refresh)
+
+
+def search_results(name):
+    """
+    Return IMDb search results for name, kept briefly so paging through them
+    doesn't search again.
+    """
+    now = datetime.now()
+    key = name.strip().lower()
+    entry = _search_cache.get(key)
+    if entry and now - entry[0] < SEARCH_TTL:
+        return entry[1]
+    results = get_ia().search_movie(name)
+    for cached_key, cached_entry in list(_search_cache.items()):
+        if now - cached_entry[0] >= SEARCH_TTL:
+            _search_cache.pop(cached_key, None)
+    _search_cache[key] = (now, results)
+    return results
+
+
+def purge_cache():
+    """
+    Drop expired entries from the IMDb data cache.
+    """
+    now = datetime.now()
+    for key, entry in list(_cache.items()):
+        if now - entry[0] >= CACHE_TTL:
+            _cache.pop(key, None)
+
+
+@_catch_and_log
+def prefetch(title_id, title_episode_id):
+    """
+    Refresh the cache with the data notify needs for a title: the current and
+    next episode of a series, or the movie details. Only titles notified
+    within CACHE_TTL should be pre-fetched, or the entries expire unused.
+    """
+    if title_episode_id:
+        current_episode = get_episode(title_episode_id, refresh=True)
+        next_episode_id = current_episode.get('next episode')
+        if next_episode_id:
+            get_episode(next_episode_id, refresh=True)
+    else:
+        get_movie(title_id, refresh=True)
+    return True
+
+
+def _episode_air_date(episode_data):
+    """
+    Parse an episode's original air date, None if it has no full date yet.
+    """
+    date_regex = r'\d{1,2}\s\w{3}.{0,1}\s\d{4}'
+    air_date = episode_data.get('original air date')
+    if air_date and match(date_regex, air_date):
+        air_date = air_date.replace('.', '').replace(',', '')
+        return datetime.strptime(air_date, '%d %b %Y')
+    return None
+
+
+def _movie_release_date(title_id):
+    """
+    Fetch a movie's USA release date, None if it has no full date yet.
+    """
+    date_regex = r'\d{1,2}\s\w{3,9}\s\d{4}'
+    result = get_ia().get_movie_release_info(title_id)
+    release_dates = result['data'].get('raw release dates') or []
+    usa_release_date = [i['date'] for i in release_dates
+                        if i['country'] == 'USA\n'
+                        and not i.get('notes')]
+    if usa_release_date and match(date_regex, usa_release_date[0]):
+        return datetime.strptime(usa_release_date[0], '%d %B %Y')
+    return None
+
+
+@_catch_and_log
+def fetch_release_date(title_id, title_episode_id):
+    """
+    Re-fetch the current release date of a movie or of a series' stored episode.
+    """
+    if title_episode_id:
+        return _episode_air_date(get_episode(title_episode_id, refresh=True))
+    return _movie_release_date(title_id)
+
+
+def _revalidation_due(title_id, title_release, today, tiers):
+    """
+    Check if a title is due a release date check today. tiers is a sequence
+    of (releasing within days, check every days) with None as the catch-all,
+    so titles releasing soon are checked more often.
+    """
+    days_left = (title_release - today).days if title_release else 0
+    every_days = 1
+    for within_days, every_days in tiers:
+        if within_days is None or days_left <= within_days:
+            break
+    # Spread titles across days so each one is checked once every every_days
+    return (today.toordinal() + int(title_id)) % max(every_days, 1) == 0
+
+
 @_catch_and_log
 def search(name):
     """
     Search for titles matching the name string and return a list of dictionaries.
     """
-    imdb_results = ia.search_movie(name)  # Search for movies by name
+    imdb_results = search_results(name)  # Search for movies by name
     titles = []
 
     for result in imdb_results[:10]:  # Limit results to the first 10
@@ -96,7 +265,13 @@ class Alert:
         Initialize database and create alerts table.
         """
         self.db_api = db.Database(db_location)
-        self.imdb_api = ia  # Use Cinemagoer instance
+
+    @property
+    def imdb_api(self):
+        """
+        Shared Cinemagoer instance, only created when an IMDb lookup is needed.
+        """
+        return get_ia()
 
     def __del__(self):
         self.db_api.close()
@@ -106,7 +281,7 @@ class Alert:
         """
         Create database and table.
         """
-        self.db_api.create_table()
+        return self.db_api.create_table()
 
 
     @_catch_and_log
@@ -183,16 +358,17 @@ class Alert:
 
 
     @_catch_and_log
-    def _update_episode(self, user_id, title_id, current_episode_data):
+    def _update_episode(self, title_id, current_episode_data):
         """
-        Get next episode ID and release date and update the database
+        Get next episode ID and release date and update the title once for
+        all of its subscribers
         """
 
         date_regex = r'\d{1,2}\s\w{3}.{0,1}\s\d{4}'
         next_episode_id = current_episode_data.get('next episode')
 
         if next_episode_id:
-            next_episode_data = self.imdb_api.get_episode(next_episode_id)
+            next_episode_data = get_episode(next_episode_id)
             next_release_date = next_episode_data.get('original air date')
             if next_release_date and match(date_regex, next_release_date):
             # next episode with valid release date found, store in database
@@ -205,11 +381,11 @@ class Alert:
                                                       second=0, microsecond=0)
                 next_episode_id = current_episode_data.getID()
 
-            db_values = (next_episode_id, release_date, user_id, title_id)
+            db_values = (next_episode_id, release_date, title_id)
             self.db_api.update(db_values)
         else:
-            # no next episode not found, assume series ended and remove alert
-            self.db_api.delete(user_id, title_id)
+            # no next episode not found, assume series ended and remove alerts
+            self.db_api.delete_title(title_id)
 
         return next_episode_id
 
@@ -272,6 +448,55 @@ class Alert:
         return results
 
 
+    @_catch_and_log
+    def releasing_on(self, days_ahead):
+        """
+        Return (title_id, title_episode_id) pairs releasing days_ahead from today
+        """
+
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        release_day = today + timedelta(days=days_ahead)
+        results = self.db_api.query_releasing(release_day,
+                                              release_day + timedelta(days=1))
+        return results
+
+
+    @_catch_and_log
+    def revalidate(self, tiers, delay=0):
+        """
+        Re-fetch release dates of titles due a check, once per title, and store
+        the ones that changed in a single transaction. Return the number of
+        changed titles.
+        """
+
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        rows = self.db_api.query_titles()
+        if not isinstance(rows, list):
+            return rows
+
+        fetched = {}
+        changes = []
+        for title_id, title_episode_id, title_release in rows:
+            key = (title_id, title_episode_id)
+            if key not in fetched:
+                if not _revalidation_due(title_id, title_release, today, tiers):
+                    continue
+                fetched[key] = fetch_release_date(title_id, title_episode_id)
+                time.sleep(delay)
+            release_date = fetched[key]
+            # skip failed lookups, unknown dates and dates notify can no longer act on
+            if not isinstance(release_date, datetime) or release_date < today:
+                continue
+            if release_date != title_release:
+                changes.append((release_date, title_id, title_episode_id))
+
+        if changes:
+            self.db_api.update_releases(changes)
+        LOG.info('Revalidated %d titles, %d release dates changed',
+                 len(fetched), len(changes))
+        return len(changes)
+
+
     @_catch_and_log
     def notify(self):
         """
@@ -285,31 +510,33 @@ class Alert:
 
         if isinstance(rows, list) and rows:
             for row in rows:
-                user_id, title_id, title_episode_id = row[0], row[1], row[2]
+                title_id, title_episode_id = row[0], row[1]
+                # subscribers are fetched first as the title may be removed below
+                user_ids = self.db_api.query_subscribers(title_id)
+                message = None
                 if title_episode_id:
-                    current_episode = self.imdb_api.get_episode(title_episode_id)
+                    current_episode = get_episode(title_episode_id)
                     current_release = current_episode['original air date'].replace(',', '')
                     current_release_date = datetime.strptime(current_release, '%d %b %Y')
-                    next_episode_id = self._update_episode(user_id, title_id, current_episode)
+                    next_episode_id = self._update_episode(title_id, current_episode)
                     if not next_episode_id:
                         # no next episode found, disable alert
                         fields = get_fields(current_episode)
                         message = 'Series finale episode!' \
                                   '(alert disabled)\n\n' + reply_message(fields)
-                        alerts.append((user_id, message))
                     elif current_release_date == today:
                         # do not notify multiple times for the same episode as some
                         # episodes are kept pending their next episode release date
                         fields = get_fields(current_episode)
                         message = 'Episode is out!!\n\n' + reply_message(fields)
-                        alerts.append((user_id, message))
                 else:
                     # movie has been release, disable alert
-                    title_data = self.imdb_api.get_movie(title_id)
+                    title_data = get_movie(title_id)
                     fields = get_fields(title_data)
                     movie_details = reply_message(fields)
                     message = 'Movie is out!\n\n' + movie_details
-                    self.db_api.delete(user_id, title_id)
-                    alerts.append((user_id, message))
+                    self.db_api.delete_title(title_id)
+                if message and isinstance(user_ids, list):
+                    alerts.extend((user_id, message) for user_id in user_ids)
 
         return alerts
@@ -0,0 +1,318 @@
+"""
+Pooled keep-alive HTTP transport with compression and conditional requests
+for the Cinemagoer IMDb client.
+
+Unlike Cinemagoer's own opener, which skips certificate checks, HTTPS
+certificates are verified against the system CA bundle. Deployments without
+one (e.g. Android/Termux) can pass ca_file, or verify=False to match
+Cinemagoer's behaviour.
+"""
+
+import copy
+import functools
+import gzip
+import http.client
+import logging
+import ssl
+import threading
+from collections import OrderedDict
+from urllib.parse import urljoin, urlsplit
+
+from imdb._exceptions import IMDbDataAccessError
+from imdb.parser.http import IMDbURLopener
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Setup logger
+LOG = logging.getLogger(__name__)
+
+ACCEPT_ENCODING = 'br, gzip' if brotli else 'gzip'
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+
+# Validators of the wrapped info set call running in this thread
+_state = threading.local()
+
+
+class NotModified(Exception):
+    """
+    Raised when IMDb answers a conditional request with 304 Not Modified
+    """
+
+
+class ConnectionPool():
+    """
+    Keep-alive HTTP(S) connections, kept idle per host for reuse
+    """
+
+    def __init__(self, size=4, timeout=30, ssl_context=None):
+        self.size = size
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._idle = {}
+        self._lock = threading.Lock()
+
+
+    def _connect(self, scheme, host):
+        """
+        Open a new connection to host
+        """
+
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, timeout=self.timeout,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(host, timeout=self.timeout)
+
+
+    def warm(self, url):
+        """
+        Open a connection to the host of url and keep it idle for the first
+        request, so it doesn't pay for the TCP and TLS handshakes
+        """
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        conn = self._connect(*key)
+        conn.connect()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append(conn)
+                conn = None
+        if conn:
+            conn.close()
+
+
+    def get(self, url, headers):
+        """
+        Send a GET request on a pooled connection and return status, headers
+        and the raw body
+        """
+
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+        for attempt in range(2):
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                conn = idle.pop() if idle else None
+            reused = conn is not None
+            if not reused:
+                conn = self._connect(*key)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                # the server may have dropped an idle connection, retry on a new one
+                if reused and attempt == 0:
+                    continue
+                raise
+
+            with self._lock:
+                idle = self._idle[key]
+                if not response.will_close and len(idle) < self.size:
+                    idle.append(conn)
+                    conn = None
+            if conn:
+                conn.close()
+            return response.status, response.headers, body
+
+
+class ResponseStore():
+    """
+    Least recently used store of validators and parsed results per info set call
+    """
+
+    def __init__(self, size=512):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        """
+        Return (validators, result) stored for key, or None
+        """
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self._entries.move_to_end(key)
+            return entry
+
+
+    def put(self, key, validators, result):
+        """
+        Store validators and result for key, evicting the oldest entries
+        """
+
+        with self._lock:
+            self._entries[key] = (validators, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def _decode(headers, body):
+    """
+    Decompress and decode a response body to a string
+    """
+
+    encoding = (headers.get('Content-Encoding') or '').lower()
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    elif encoding == 'br' and brotli:
+        body = brotli.decompress(body)
+    return str(body, headers.get_content_charset() or 'utf8', 'replace')
+
+
+class PooledURLopener(IMDbURLopener):
+    """
+    Cinemagoer URL opener fetching through a ConnectionPool, with compression
+    and conditional requests for the info set call being run
+    """
+
+    def __init__(self, pool, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = pool
+
+
+    def retrieve_unicode(self, url, size=-1):
+        """
+        Retrieve the given URL and return it as a string, raising NotModified
+        if the stored validators for it are still current
+        """
+
+        if 'http' in self.proxies:
+            # proxies are left to Cinemagoer's own urllib opener
+            return super().retrieve_unicode(url, size=size)
+
+        headers = dict(self.addheaders)
+        headers['Accept-Encoding'] = ACCEPT_ENCODING
+        call = getattr(_state, 'call', None)
+        if size != -1:
+            headers['Range'] = 'bytes=0-{0}'.format(size)
+        elif call is not None and url in call['stored']:
+            etag, last_modified = call['stored'][url]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        request_url = url
+        try:
+            for _ in range(MAX_REDIRECTS + 1):
+                status, response_headers, body = self.pool.get(request_url, headers)
+                location = response_headers.get('Location')
+                if status not in REDIRECT_CODES or not location:
+                    break
+                request_url = urljoin(request_url, location)
+        except (http.client.HTTPException, OSError) as err:
+            raise IMDbDataAccessError({'url': request_url,
+                                       'errmsg': str(err),
+                                       'exception type': type(err).__name__,
+                                       'original exception': err})
+        self._last_url = request_url
+
+        if status == 304:
+            raise NotModified(url)
+        if status == 404:
+            LOG.warning('404 code returned for %s', request_url)
+            return ''
+        if status >= 400:
+            raise IMDbDataAccessError({'url': request_url,
+                                       'errcode': status,
+                                       'headers': response_headers,
+                                       'error type': 'http_error_default'})
+
+        if call is not None and size == -1:
+            call['fetched'][url] = (response_headers.get('ETag'),
+                                    response_headers.get('Last-Modified'))
+        return _decode(response_headers, body)
+
+
+def _copy_result(result):
+    """
+    Copy a parsed info set result down to its data mapping, which Cinemagoer
+    merges into Movie objects, so the stored result isn't shared
+    """
+
+    result = copy.copy(result)
+    if isinstance(result, dict) and 'data' in result:
+        result['data'] = dict(result['data'])
+    return result
+
+
+def _conditional(store, name, method):
+    """
+    Wrap a Cinemagoer info set method so a 304 returns the stored parsed
+    result instead of fetching and parsing the page again
+    """
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        key = (name, args, tuple(sorted(kwargs.items())))
+        entry = store.get(key)
+        stored = entry[0] if entry else {}
+        # only single page info sets can be revalidated as a whole
+        call = {'stored': stored if len(stored) == 1 else {}, 'fetched': {}}
+        outer_call = getattr(_state, 'call', None)
+        _state.call = call
+        try:
+            result = method(*args, **kwargs)
+        except NotModified:
+            LOG.debug('Not modified, reusing parsed %s%s', name, args)
+            call['fetched'] = dict(stored)
+            return _copy_result(entry[1])
+        finally:
+            _state.call = outer_call
+            # pages fetched by a nested info set call count towards the outer one
+            if outer_call is not None:
+                outer_call['fetched'].update(call['fetched'])
+
+        validators = {url: pair for url, pair in call['fetched'].items() if any(pair)}
+        if validators and len(validators) == len(call['fetched']):
+            store.put(key, validators, _copy_result(result))
+        return result
+    return wrapper
+
+
+def ssl_context(ca_file=None, verify=True):
+    """
+    Create the SSL context for IMDb connections, verifying certificates against
+    ca_file or the system CA bundle unless verify is False
+    """
+
+    context = ssl.create_default_context(cafile=ca_file)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def install(ia, pool_size=4, store_size=512, timeout=30, ca_file=None, verify=True):
+    """
+    Route a Cinemagoer instance's page fetches through a keep-alive pool and
+    make its movie info set lookups conditional
+    """
+
+    pool = ConnectionPool(pool_size, timeout, ssl_context(ca_file, verify))
+    opener = PooledURLopener(pool)
+    opener.addheaders = list(ia.urlOpener.addheaders)
+    opener.proxies = dict(ia.urlOpener.proxies)
+    ia.urlOpener = opener
+
+    store = ResponseStore(store_size)
+    for name in dir(ia):
+        if name.startswith('get_movie_') and name != 'get_movie_infoset':
+            method = getattr(ia, name)
+            if callable(method):
+                setattr(ia, name, _conditional(store, name, method))
+    return ia